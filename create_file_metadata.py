@@ -1,55 +1,59 @@
 import os
 import json
+import argparse
+import warnings
 import hashlib
+import numpy as np
+from file_metadata_utils import (
+    HASH_ALGORITHMS,
+    MD5_DEPRECATION_MESSAGE,
+    calculate_numeric_hash,
+    encode_paths,
+    list_file_entries,
+)
 from tqdm import tqdm
 
 
-def calculate_file_metadata_initial(directory, output_file, hash_algorithm="md5"):
+def calculate_file_metadata_initial(directory, output_file, hash_algorithm="blake3"):
     """
-    Calculate file metadata (numeric hash, size, timestamp) for all files in a directory
-    and store the results in a JSON file.
+    Calculate file metadata (path, numeric 64-bit hash, size, timestamp) for all files in
+    a directory and store the results in a .npz file with one array per field. Paths are
+    stored relative to the directory, along with the hash algorithm.
 
     Args:
         directory (str): Path to the directory to scan.
-        output_file (str): Path to the JSON file where metadata will be stored.
-        hash_algorithm (str): Hashing algorithm to use (default: 'sha256').
+        output_file (str): Path to the .npz file where metadata will be stored.
+        hash_algorithm (str): Hashing algorithm to use (default: 'blake3'). Hashes are
+            truncated to 64 bits, as expected by the integrity checks.
 
     Returns:
         None
     """
-    file_metadata = []
+    if hash_algorithm == "md5":
+        warnings.warn(MD5_DEPRECATION_MESSAGE, DeprecationWarning, stacklevel=2)
+
+    paths = []
+    hashes = []
+    sizes = []
+    timestamps = []
 
     # Walk through the directory and process each file
-    for root, _, files in os.walk(directory):
-        for file in tqdm(files):
-            file_path = os.path.join(root, file)
-            try:
-                # Calculate file hash
-                hash_func = hashlib.new(hash_algorithm)
-                with open(file_path, "rb") as f:
-                    while chunk := f.read(8192):  # Read file in chunks to handle large files
-                        hash_func.update(chunk)
-                file_hash = hash_func.hexdigest()
-
-                # Convert hash to a numeric value
-                hash_numeric = int(file_hash, 16)
-
-                # Get file size and last modification timestamp
-                file_size = os.path.getsize(file_path)
-                file_timestamp = os.path.getmtime(file_path)
-
-                # Append metadata to the list
-                file_metadata.append({
-                    "hash": hash_numeric,  # Numeric representation of the hash
-                    "size": file_size,  # File size in bytes
-                    "timestamp": file_timestamp  # Last modification time
-                })
-            except Exception as e:
-                print(f"Error processing file {file_path}: {e}")
-
-    # Write metadata to a JSON file
-    with open(output_file, "w") as f:
-        json.dump(file_metadata, f, indent=4)
+    for file_path, file_size, file_timestamp in tqdm(list_file_entries(directory)):
+        try:
+            # Calculate file hash, as a numeric value truncated to 64 bits. Files are hashed
+            # one after another, so blake3 may spread each one over all cores
+            hash_numeric = calculate_numeric_hash(file_path, hash_algorithm, max_threads=None)
+
+            # Append metadata to the lists
+            paths.append(os.path.relpath(file_path, directory))  # Path relative to the directory
+            hashes.append(hash_numeric)  # Numeric representation of the truncated hash
+            sizes.append(file_size)  # File size in bytes
+            timestamps.append(file_timestamp)  # Last modification time
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+
+    # Write metadata to a .npz file
+    save_metadata(output_file, paths, hashes, sizes, timestamps, hash_algorithm)
 
     print(f"File metadata saved to {output_file}")
 
@@ -66,20 +70,53 @@ def calculate_file_hash(file_path, hash_algorithm="sha256"):
         str: Hexadecimal hash of the file.
     """
     hash_func = hashlib.new(hash_algorithm)
+    buffer = bytearray(1 << 20)  # Reused for every chunk of the file
+    view = memoryview(buffer)
     with open(file_path, "rb") as f:
-        while chunk := f.read(8192):  # Read file in chunks to handle large files
-            hash_func.update(chunk)
+        while num_read := f.readinto(buffer):  # Read file in chunks to handle large files
+            hash_func.update(view[:num_read])
     return hash_func.hexdigest()
 
 
+def save_metadata(output_file, paths, hashes, sizes, timestamps, hash_algorithm):
+    """
+    Save file metadata as typed arrays in a compressed .npz file. Paths are packed into
+    a byte blob and an offsets array (see encode_paths). The hash algorithm is stored
+    too, so that the integrity checks hash with the same one.
+
+    Args:
+        output_file (str): Path to the .npz file where metadata will be stored.
+        paths (list): File paths relative to the scanned directory.
+        hashes (list): Truncated 64-bit file hashes.
+        sizes (list): File sizes in bytes.
+        timestamps (list): Last modification times.
+        hash_algorithm (str): Hashing algorithm the hashes were calculated with.
+
+    Returns:
+        None
+    """
+    path_blob, path_offsets = encode_paths(paths)
+    np.savez_compressed(
+        output_file,
+        path_blob=path_blob,
+        path_offsets=path_offsets,
+        hash=np.asarray(hashes, dtype=np.uint64),
+        size=np.asarray(sizes, dtype=np.int64),
+        timestamp=np.asarray(timestamps, dtype=np.float64),
+        algo=np.asarray(hash_algorithm),
+    )
+
+
 def truncate_hashes_in_json(input_file, output_file, bits=64):
     """
-    Open a JSON file, truncate each 128-bit hash to 64 bits, and save the updated data.
+    Open a legacy JSON metadata file, truncate each 128-bit hash to 64 bits, and save
+    the updated data as a .npz file. Only needed for baselines written with full-width
+    hashes; calculate_file_metadata_initial already stores truncated hashes.
 
     Args:
         input_file (str): Path to the input JSON file with 128-bit hashes.
-        output_file (str): Path to the output JSON file with truncated 64-bit hashes.
-        bits (int): Number of bits to truncate the hash to (default: 64).
+        output_file (str): Path to the output .npz file with truncated 64-bit hashes.
+        bits (int): Number of bits to truncate the hash to, at most 64 (default: 64).
 
     Returns:
         None
@@ -88,30 +125,46 @@ def truncate_hashes_in_json(input_file, output_file, bits=64):
     with open(input_file, "r") as f:
         file_metadata = json.load(f)
 
-    # Truncate each hash
-    for entry in file_metadata:
-        original_hash = entry["hash"]
-        truncated_hash = original_hash & ((1 << bits) - 1)  # Keep only the lower `bits` bits
-        entry["hash"] = truncated_hash  # Update the hash in the metadata
-
-    # Save the updated metadata to a new JSON file
-    with open(output_file, "w") as f:
-        json.dump(file_metadata, f, indent=4)
+    # Truncate all hashes in one pass, keeping only the lower `bits` bits
+    mask = (1 << bits) - 1
+    truncated_hashes = np.fromiter(
+        (entry["hash"] & mask for entry in file_metadata), dtype=np.uint64, count=len(file_metadata)
+    )
+
+    # Save the updated metadata to a new file; legacy files carry no paths and were hashed with md5
+    save_metadata(
+        output_file,
+        [""] * len(file_metadata),
+        truncated_hashes,
+        [entry["size"] for entry in file_metadata],
+        [entry["timestamp"] for entry in file_metadata],
+        "md5",
+    )
 
     print(f"Truncated hashes saved to {output_file}")
 
 
-# Input JSON file with 128-bit hashes
-input_json = "file_metadata.json"
+def main():
+    parser = argparse.ArgumentParser(description="Create the baseline metadata of the files in a directory.")
+    parser.add_argument(
+        "--algo",
+        choices=HASH_ALGORITHMS,
+        default="blake3",
+        help="hash algorithm to create the baseline with (default: blake3); sha256 is faster "
+        "than md5 on CPUs with SHA-NI (grep sha_ni /proc/cpuinfo), md5 is deprecated",
+    )
+    args = parser.parse_args()
+
+    # Output file with truncated 64-bit hashes
+    output_npz = "file_metadata.npz"
 
-# Output JSON file with truncated 64-bit hashes
-output_json = "file_metadata_truncated.json"
+    # Directory to scan
+    directory_to_scan = r"D:\Stuff\Images"
 
-# Directory to scan
-directory_to_scan = r"D:\Stuff\Images"
+    # Calculate metadata and save to .npz, hashes are truncated while scanning. The algorithm
+    # is recorded in the baseline, so the integrity checks pick it up on their own
+    calculate_file_metadata_initial(directory_to_scan, output_npz, hash_algorithm=args.algo)
 
-# Calculate metadata and save to JSON
-calculate_file_metadata_initial(directory_to_scan, input_json, hash_algorithm="md5")
 
-# Truncate hashes and save to a new file
-truncate_hashes_in_json(input_json, output_json)
+if __name__ == "__main__":
+    main()
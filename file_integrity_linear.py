@@ -1,120 +1,200 @@
-import os
-import json
-import hashlib
+import argparse
+import warnings
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from file_metadata_utils import (
+    HASH_ALGORITHMS,
+    MD5_DEPRECATION_MESSAGE,
+    calculate_numeric_hash,
+    decode_paths,
+    list_file_entries,
+    matches_baseline,
+)
 from tqdm import tqdm
 
+# Number of files read and hashed concurrently, enough to keep
+# several reads in flight on an SSD/NVMe queue
+HASH_LANES = 16
 
-def load_baseline_metadata(json_file):
+# Files submitted to the lanes ahead of the one being compared, so memory stays
+# bounded however many files are scanned
+MAX_PENDING = HASH_LANES * 4
+
+
+def load_baseline_metadata(baseline_file):
     """
-    Load baseline metadata from a JSON file into a numpy array.
+    Load baseline metadata from a .npz file into one numpy array per field.
 
     Args:
-        json_file (str): Path to the JSON file containing baseline metadata.
+        baseline_file (str): Path to the .npz file containing baseline metadata.
 
     Returns:
-        np.ndarray: Numpy array containing baseline metadata (hash, size, timestamp).
+        tuple: (hashes, sizes, timestamps, hash_to_idx, path_to_idx, hash_algorithm) where
+        hashes (np.uint64), sizes (np.int64) and timestamps (np.float64) are 1-D arrays,
+        hash_to_idx and path_to_idx map each hash and each relative path to its index
+        in those arrays, and hash_algorithm is the algorithm the hashes were calculated with.
     """
-    with open(json_file, "r") as f:
-        baseline_metadata = json.load(f)
+    with np.load(baseline_file) as baseline:
+        hashes = baseline["hash"]  # Truncated hash (64-bit integer)
+        sizes = baseline["size"]  # File size
+        timestamps = baseline["timestamp"]  # File timestamp
+        paths = decode_paths(baseline["path_blob"], baseline["path_offsets"])  # Relative to the scanned directory
+        hash_algorithm = str(baseline["algo"])  # Hash algorithm of the baseline
 
-    num_files = len(baseline_metadata)
-    shared_array = np.zeros((num_files, 3), dtype=np.float64)
+    num_files = len(hashes)
 
-    for i, entry in enumerate(baseline_metadata):
-        shared_array[i, 0] = entry["hash"]  # Truncated hash (64-bit integer)
-        shared_array[i, 1] = entry["size"]  # File size
-        shared_array[i, 2] = entry["timestamp"]  # File timestamp
+    # Built once, so every per-file lookup is O(1) instead of a scan of the baseline.
+    # Inserted in reverse so that, for duplicate hashes, the first entry wins
+    hash_to_idx = dict(zip(reversed(hashes.tolist()), reversed(range(num_files))))
+    path_to_idx = dict(zip(paths, range(num_files)))
 
-    return shared_array
+    return hashes, sizes, timestamps, hash_to_idx, path_to_idx, hash_algorithm
 
 
-def calculate_file_metadata(file_path, hash_algorithm="md5"):
+def calculate_file_metadata(file_entry, hash_algorithm="blake3"):
     """
     Calculate file metadata (hash, size, timestamp) for a single file.
 
     Args:
-        file_path (str): Path to the file.
-        hash_algorithm (str): Hashing algorithm to use (default: 'md5').
+        file_entry (tuple): (file_path, file_size, file_timestamp) from list_file_entries.
+        hash_algorithm (str): Hashing algorithm to use (default: 'blake3').
 
     Returns:
         dict: Metadata for the file (hash, size, timestamp).
     """
+    file_path, file_size, file_timestamp = file_entry
     try:
-        hash_func = hashlib.new(hash_algorithm)
-        with open(file_path, "rb") as f:
-            while chunk := f.read(8192):
-                hash_func.update(chunk)
-        file_hash = hash_func.hexdigest()
-
-        # Convert hash to numeric and truncate to 64 bits
-        hash_numeric = int(file_hash, 16) & ((1 << 64) - 1)
-
-        # Get file size and last modification timestamp
-        file_size = os.path.getsize(file_path)
-        file_timestamp = os.path.getmtime(file_path)
-
+        # One thread per file, the HASH_LANES lanes already hash files concurrently
+        hash_numeric = calculate_numeric_hash(file_path, hash_algorithm, max_threads=1)
         return {"hash": hash_numeric, "size": file_size, "timestamp": file_timestamp}
     except FileNotFoundError:
         return None
 
 
-def process_files(directory, baseline_array):
+def iter_file_metadata(file_entries, executor, hash_algorithm="blake3"):
+    """
+    Calculate file metadata for each file on the executor's lanes, keeping at most
+    MAX_PENDING files in flight. Each completed file is replaced by the next one, so
+    the lanes stay busy without a barrier between groups of files.
+
+    Args:
+        file_entries (list): Entries of the files, from list_file_entries.
+        executor (ThreadPoolExecutor): Executor providing the hashing lanes.
+        hash_algorithm (str): Hashing algorithm to use (default: 'blake3').
+
+    Yields:
+        tuple: (file_path, metadata) of each file, in the order of file_entries.
+    """
+    pending = deque()
+    for file_entry in file_entries:
+        if len(pending) == MAX_PENDING:
+            file_path, future = pending.popleft()
+            yield file_path, future.result()
+        pending.append((file_entry[0], executor.submit(calculate_file_metadata, file_entry, hash_algorithm)))
+
+    while pending:
+        file_path, future = pending.popleft()
+        yield file_path, future.result()
+
+
+def process_files(
+    directory, baseline_sizes, baseline_timestamps, hash_to_idx, path_to_idx, force_rehash=False, hash_algorithm="blake3"
+):
     """
     Process files in a directory and compare their metadata with the baseline.
 
     Args:
         directory (str): Path to the directory to scan.
-        baseline_array (np.ndarray): Numpy array containing baseline metadata.
+        baseline_sizes (np.ndarray): Baseline file sizes.
+        baseline_timestamps (np.ndarray): Baseline file timestamps.
+        hash_to_idx (dict): Maps each baseline hash to its index in the arrays.
+        path_to_idx (dict): Maps each baseline path to its index in the arrays.
+        force_rehash (bool): Hash every file, even if its size and timestamp match
+            its baseline entry (default: False).
+        hash_algorithm (str): Hashing algorithm the baseline was created with (default: 'blake3').
 
     Returns:
         list: List of alerts for file changes.
     """
     alerts = []
-    baseline_hashes = baseline_array[:, 0]
-    baseline_sizes = baseline_array[:, 1]
-    baseline_timestamps = baseline_array[:, 2]
 
     # Iterate through all files in the directory
-    file_paths = [
-        os.path.join(root, file)
-        for root, _, files in os.walk(directory)
-        for file in files
-    ]
-
-    # Use tqdm for progress tracking
-    for file_path in tqdm(file_paths, desc="Processing Files"):
-        current_metadata = calculate_file_metadata(file_path)
-
-        if current_metadata is None:
-            alerts.append(f"File not found: {file_path}")
-            continue
-
-        if current_metadata["hash"] not in baseline_hashes:
-            alerts.append(f"New file detected: {file_path}")
-        else:
-            idx = np.where(baseline_hashes == current_metadata["hash"])[0][0]
-            if current_metadata["size"] != baseline_sizes[idx]:
-                alerts.append(f"File size changed: {file_path}")
-            if current_metadata["timestamp"] != baseline_timestamps[idx]:
-                alerts.append(f"File timestamp changed: {file_path}")
+    file_entries = list_file_entries(directory)
+
+    # Skip hashing files whose size and timestamp are unchanged since the baseline
+    if not force_rehash:
+        file_entries = [
+            file_entry
+            for file_entry in file_entries
+            if not matches_baseline(file_entry, directory, path_to_idx, baseline_sizes, baseline_timestamps)
+        ]
+
+    # Hash the files on HASH_LANES threads. hashlib and blake3 release the GIL while digesting
+    # large buffers, so the lanes run concurrently. Results come back in order, using tqdm
+    # for progress tracking
+    with ThreadPoolExecutor(max_workers=HASH_LANES) as executor:
+        metadata = iter_file_metadata(file_entries, executor, hash_algorithm)
+        for file_path, current_metadata in tqdm(metadata, total=len(file_entries), desc="Processing Files"):
+            if current_metadata is None:
+                alerts.append(f"File not found: {file_path}")
+                continue
+
+            idx = hash_to_idx.get(current_metadata["hash"])
+            if idx is None:
+                alerts.append(f"New file detected: {file_path}")
+            else:
+                if current_metadata["size"] != baseline_sizes[idx]:
+                    alerts.append(f"File size changed: {file_path}")
+                if current_metadata["timestamp"] != baseline_timestamps[idx]:
+                    alerts.append(f"File timestamp changed: {file_path}")
 
     return alerts
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Compare the files in a directory with the baseline metadata.")
+    parser.add_argument(
+        "--force-rehash",
+        action="store_true",
+        help="hash every file, even if its size and timestamp match the baseline",
+    )
+    parser.add_argument(
+        "--algo",
+        choices=HASH_ALGORITHMS,
+        help="hash algorithm the baseline was created with (default: the one recorded in the "
+        "baseline); exits if it does not match the baseline",
+    )
+    args = parser.parse_args()
+
     # Configuration
     directory_to_scan = r"E:\Images"
-    baseline_json = "file_metadata_truncated.json"
+    baseline_file = "file_metadata.npz"
 
     # Load baseline metadata
     print("Loading baseline metadata...")
-    baseline_array = load_baseline_metadata(baseline_json)
+    _, baseline_sizes, baseline_timestamps, hash_to_idx, path_to_idx, hash_algorithm = load_baseline_metadata(
+        baseline_file
+    )
     print("Baseline metadata loaded.")
 
-    # Process files sequentially
+    # Hash with the baseline's algorithm, any other would report every file as new
+    if args.algo is not None and args.algo != hash_algorithm:
+        parser.error(f"--algo {args.algo} does not match the baseline, which was created with {hash_algorithm}")
+    if hash_algorithm == "md5":
+        warnings.warn(MD5_DEPRECATION_MESSAGE, DeprecationWarning, stacklevel=2)
+
+    # Process files on the hashing lanes
     print("Processing files...")
-    alerts = process_files(directory_to_scan, baseline_array)
+    alerts = process_files(
+        directory_to_scan,
+        baseline_sizes,
+        baseline_timestamps,
+        hash_to_idx,
+        path_to_idx,
+        args.force_rehash,
+        hash_algorithm,
+    )
 
     # Print all alerts at the end
     print("\n--- Alerts ---")
@@ -1,171 +1,220 @@
-import os
-import json
-import hashlib
+import argparse
+import warnings
 import numpy as np
 import multiprocessing as mp
-from mp_shared_array import MemorySharedNumpyArray
+from functools import partial
+from numba import njit, prange, types
+from numba.typed import Dict
+from file_metadata_utils import (
+    HASH_ALGORITHMS,
+    MD5_DEPRECATION_MESSAGE,
+    calculate_numeric_hash,
+    decode_paths,
+    list_file_entries,
+    matches_baseline,
+)
 from tqdm import tqdm
 
+# Alert codes written by compare_metadata, combined as bit flags
+ALERT_NEW_FILE = 1
+ALERT_SIZE_CHANGED = 2
+ALERT_TIMESTAMP_CHANGED = 4
 
-def load_baseline_metadata(json_file, shared_array):
-    with open(json_file, "r") as f:
-        baseline_metadata = json.load(f)
+# Metadata record of a single file
+META_DT = np.dtype([("hash", "u8"), ("size", "i8"), ("ts", "f8")])
 
-    np_array = shared_array.get_numpy_handle()
-    shared_array.get_lock().acquire()  # locking the shared memory array for reading
 
-    for i, entry in enumerate(baseline_metadata):
-        np_array[i, 0] = entry["hash"]
-        np_array[i, 1] = entry["size"]
-        np_array[i, 2] = entry["timestamp"]
+def load_baseline_metadata(baseline_file):
+    with np.load(baseline_file) as baseline:
+        hashes = baseline["hash"]
+        sizes = baseline["size"]
+        timestamps = baseline["timestamp"]
+        paths = decode_paths(baseline["path_blob"], baseline["path_offsets"])
+        hash_algorithm = str(baseline["algo"])
 
-    shared_array.get_lock().release()  # release the lock after reading the data
+    path_to_idx = dict(zip(paths, range(len(paths))))
 
+    return hashes, sizes, timestamps, path_to_idx, hash_algorithm
 
-def calculate_file_metadata(file_path, hash_algorithm="md5"):
+
+def calculate_file_metadata(file_entry, hash_algorithm="blake3"):
+    file_path, file_size, file_timestamp = file_entry
     try:
-        hash_func = hashlib.new(hash_algorithm)
-        with open(file_path, "rb") as f:
-            while chunk := f.read(8192):
-                hash_func.update(chunk)
-        file_hash = hash_func.hexdigest()
-        hash_numeric = int(file_hash, 16) & ((1 << 64) - 1)
-        file_size = os.path.getsize(file_path)
-        file_timestamp = os.path.getmtime(file_path)
-        return {"hash": hash_numeric, "size": file_size, "timestamp": file_timestamp}
+        # One thread per file, the pool workers already hash files concurrently
+        hash_numeric = calculate_numeric_hash(file_path, hash_algorithm, max_threads=1)
+        return np.array((hash_numeric, file_size, file_timestamp), dtype=META_DT)
     except FileNotFoundError:
         return None
 
 
-def producer_process(directory, queue, stop_event, buffer_size):
+def file_metadata_task(file_entry, hash_algorithm="blake3"):
     """
-    Producer process to read files from the directory and load them into the queue.
+    Pool task calculating the metadata of a single file.
 
     Args:
-        directory (str): Path to the directory to scan.
-        queue (mp.Queue): Queue to store file paths.
-        stop_event (mp.Event): Event to signal when the producer is done.
-        buffer_size (int): Maximum size of the queue.
+        file_entry (tuple): (file_path, file_size, file_timestamp) from list_file_entries.
+        hash_algorithm (str): Hashing algorithm to use (default: 'blake3').
 
     Returns:
-        None
+        tuple: (file_path, metadata, error) where metadata is a META_DT record, or None
+        if the file could not be read, and error describes any unexpected failure.
     """
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            queue.put(file_path)  # Add file path to the queue
-            while queue.qsize() >= buffer_size:  # Wait if the queue is full
-                pass
-    stop_event.set()  # Signal that the producer is done
+    file_path = file_entry[0]
+    try:
+        return file_path, calculate_file_metadata(file_entry, hash_algorithm), None
+    except Exception as e:
+        return file_path, None, str(e)
 
 
-def worker_process(queue, shared_array, progress_counter, stop_event, alert_list):
+@njit(cache=True)
+def build_hash_index(hashes):
     """
-    Worker process to calculate file metadata and compare with baseline.
+    Build a typed dict mapping each baseline hash to its index, usable from nopython code.
 
     Args:
-        queue (mp.Queue): Queue containing file paths to process.
-        shared_array (MemorySharedNumpyArray): Shared memory array for baseline metadata.
-        progress_counter (mp.Value): Shared counter for progress tracking.
-        stop_event (mp.Event): Event to signal when the producer is done.
-        alert_list (mp.Manager().list): Shared list to store alerts.
+        hashes (np.ndarray): Baseline hashes (uint64).
 
     Returns:
-        None
+        numba.typed.Dict: Maps each hash to the index of its first baseline entry.
     """
-    while not (queue.empty() and stop_event.is_set()):
-        try:
-            file_path = queue.get()
-            if file_path == "STOP":
-                break
-
-            current_metadata = calculate_file_metadata(file_path)
-
-            if current_metadata is None:
-                with progress_counter.get_lock():
-                    progress_counter.value += 1
-                continue
+    hash_to_idx = Dict.empty(key_type=types.uint64, value_type=types.int64)
+    for i in range(hashes.shape[0] - 1, -1, -1):  # Walk backwards so the first entry wins
+        hash_to_idx[hashes[i]] = i
+    return hash_to_idx
 
-            # Compare with baseline
 
-            np_array = shared_array.get_numpy_handle()
-            shared_array.get_lock().acquire()
-            baseline_hashes = np_array[:, 0]
-            baseline_sizes = np_array[:, 1]
-            baseline_timestamps = np_array[:, 2]
-            shared_array.get_lock().release()
+@njit(parallel=True, cache=True)
+def compare_metadata(cur_hash, cur_size, cur_ts, hash_to_idx, base_size, base_ts, out):
+    """
+    Compare a batch of file metadata with the baseline.
 
-            if current_metadata["hash"] not in baseline_hashes:
-                alert_list.append(f"New file detected: {file_path}")
-            else:
-                idx = np.where(baseline_hashes == current_metadata["hash"])[0][0]
-                if current_metadata["size"] != baseline_sizes[idx]:
-                    alert_list.append(f"File size changed: {file_path}")
-                if current_metadata["timestamp"] != baseline_timestamps[idx]:
-                    alert_list.append(f"File timestamp changed: {file_path}")
+    Args:
+        cur_hash (np.ndarray): Hashes of the scanned files (uint64).
+        cur_size (np.ndarray): Sizes of the scanned files (int64).
+        cur_ts (np.ndarray): Timestamps of the scanned files (float64).
+        hash_to_idx (numba.typed.Dict): Maps each baseline hash to its index, see build_hash_index.
+        base_size (np.ndarray): Baseline file sizes (int64).
+        base_ts (np.ndarray): Baseline file timestamps (float64).
+        out (np.ndarray): Output alert codes, one per scanned file (0 if unchanged).
 
-            with progress_counter.get_lock():
-                progress_counter.value += 1
-        except Exception as e:
-            alert_list.append(f"Error processing file {file_path}: {e}")
-            with progress_counter.get_lock():
-                progress_counter.value += 1
+    Returns:
+        None
+    """
+    for k in prange(cur_hash.shape[0]):
+        if cur_hash[k] in hash_to_idx:
+            idx = hash_to_idx[cur_hash[k]]
+            code = 0
+            if cur_size[k] != base_size[idx]:
+                code |= ALERT_SIZE_CHANGED
+            if cur_ts[k] != base_ts[idx]:
+                code |= ALERT_TIMESTAMP_CHANGED
+            out[k] = code
+        else:
+            out[k] = ALERT_NEW_FILE
 
 
 def main():
-    directory_to_scan = r"E:\Images"
-    baseline_json = "file_metadata_truncated.json"
-    num_processes = mp.cpu_count() - 2
-    buffer_size = 100
+    parser = argparse.ArgumentParser(description="Compare the files in a directory with the baseline metadata.")
+    parser.add_argument(
+        "--force-rehash",
+        action="store_true",
+        help="hash every file, even if its size and timestamp match the baseline",
+    )
+    parser.add_argument(
+        "--algo",
+        choices=HASH_ALGORITHMS,
+        help="hash algorithm the baseline was created with (default: the one recorded in the "
+        "baseline); exits if it does not match the baseline",
+    )
+    args = parser.parse_args()
 
-    num_files = sum(len(files) for _, _, files in os.walk(directory_to_scan))
-    print(f"Total files in directory: {num_files}")
+    directory_to_scan = r"E:\Images"
+    baseline_file = "file_metadata.npz"
+    num_processes = max(1, mp.cpu_count() - 2)
+    chunksize = 64
 
-    shared_array = MemorySharedNumpyArray(
-        dtype=np.float64, shape=(num_files, 3), sampling=1, lock=True
-    )
+    file_entries = list_file_entries(directory_to_scan)
+    print(f"Total files in directory: {len(file_entries)}")
 
+    # The baseline stays in the main process: workers only hash, all comparisons happen here
     print("Loading baseline metadata...")
-    load_baseline_metadata(baseline_json, shared_array)
+    baseline_hashes, baseline_sizes, baseline_timestamps, path_to_idx, hash_algorithm = load_baseline_metadata(
+        baseline_file
+    )
+    hash_to_idx = build_hash_index(baseline_hashes)
     print("Baseline metadata loaded.")
 
-    file_queue = mp.Queue()
-    stop_event = mp.Event()
-    progress_counter = mp.Value("i", 0)
-
-    # Shared list for alerts
-    manager = mp.Manager()
-    alert_list = manager.list()
-
-    # Start the producer process
-    producer = mp.Process(target=producer_process, args=(directory_to_scan, file_queue, stop_event, buffer_size))
-    producer.start()
-
-    # Create a progress bar for file processing
-    progress_bar = tqdm(total=num_files, desc="Processing Files", position=0)
+    # Hash with the baseline's algorithm, any other would report every file as new
+    if args.algo is not None and args.algo != hash_algorithm:
+        parser.error(f"--algo {args.algo} does not match the baseline, which was created with {hash_algorithm}")
+    if hash_algorithm == "md5":
+        warnings.warn(MD5_DEPRECATION_MESSAGE, DeprecationWarning, stacklevel=2)
+
+    # Compile the comparator up front, so that it cannot fail only after every file was hashed.
+    # Both calls pass contiguous copies of the record fields, so they share one specialization
+    empty = np.empty(0, dtype=META_DT)
+    compare_metadata(
+        np.ascontiguousarray(empty["hash"]),
+        np.ascontiguousarray(empty["size"]),
+        np.ascontiguousarray(empty["ts"]),
+        hash_to_idx,
+        baseline_sizes,
+        baseline_timestamps,
+        np.zeros(0, dtype=np.int64),
+    )
 
-    # Start worker processes
-    processes = []
-    for _ in range(num_processes):
-        p = mp.Process(target=worker_process, args=(file_queue, shared_array, progress_counter, stop_event, alert_list))
-        processes.append(p)
-        p.start()
+    # Skip hashing files whose size and timestamp are unchanged since the baseline
+    if not args.force_rehash:
+        file_entries = [
+            file_entry
+            for file_entry in file_entries
+            if not matches_baseline(file_entry, directory_to_scan, path_to_idx, baseline_sizes, baseline_timestamps)
+        ]
+        print(f"Files to hash: {len(file_entries)}")
+
+    alerts = []
+    current_paths = []
+    current = np.empty(len(file_entries), dtype=META_DT)
+    with mp.Pool(num_processes) as pool:
+        results = pool.imap_unordered(
+            partial(file_metadata_task, hash_algorithm=hash_algorithm), file_entries, chunksize=chunksize
+        )
+        for file_path, current_metadata, error in tqdm(results, total=len(file_entries), desc="Processing Files"):
+            if error is not None:
+                alerts.append(f"Error processing file {file_path}: {error}")
+                continue
 
-    # Update the progress bar in the main process
-    while progress_counter.value < num_files:
-        progress_bar.n = progress_counter.value
-        progress_bar.refresh()
+            if current_metadata is None:
+                continue
 
-    # Wait for all processes to finish
-    for p in processes:
-        p.join()
+            current[len(current_paths)] = current_metadata
+            current_paths.append(file_path)
+
+    # Compare all files with the baseline in one pass
+    current = current[:len(current_paths)]
+    alert_codes = np.zeros(len(current), dtype=np.int64)
+    compare_metadata(
+        np.ascontiguousarray(current["hash"]),
+        np.ascontiguousarray(current["size"]),
+        np.ascontiguousarray(current["ts"]),
+        hash_to_idx,
+        baseline_sizes,
+        baseline_timestamps,
+        alert_codes,
+    )
 
-    producer.join()
-    progress_bar.close()
+    for k in np.flatnonzero(alert_codes):
+        file_path = current_paths[k]
+        if alert_codes[k] & ALERT_NEW_FILE:
+            alerts.append(f"New file detected: {file_path}")
+        if alert_codes[k] & ALERT_SIZE_CHANGED:
+            alerts.append(f"File size changed: {file_path}")
+        if alert_codes[k] & ALERT_TIMESTAMP_CHANGED:
+            alerts.append(f"File timestamp changed: {file_path}")
 
     # Print all alerts at the end
     print("\n--- Alerts ---")
-    for alert in alert_list:
+    for alert in alerts:
         print(alert)
 
     print("File comparison complete.")
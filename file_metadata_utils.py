@@ -0,0 +1,165 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+# Files are hashed in chunks of this size, read into a buffer reused for every file.
+# They are deliberately not memory-mapped: a file truncated while its mapping is hashed
+# raises SIGBUS, which kills the process (and hangs a multiprocessing.Pool waiting on it)
+READ_CHUNK_SIZE = 1 << 20
+
+# Hash algorithms accepted by --algo, recorded in the baseline
+HASH_ALGORITHMS = ("blake3", "sha256", "md5")
+
+# Warning emitted whenever md5 is selected
+MD5_DEPRECATION_MESSAGE = "MD5 is only kept for legacy baselines, use blake3 or sha256 instead"
+
+# One read buffer per thread
+_read_buffers = threading.local()
+
+
+def iter_file_entries(root):
+    """
+    Recursively yield the directory entry of every regular file below a directory.
+    Directories that cannot be listed (e.g. permission denied) are skipped, like os.walk.
+    Each directory is closed before its subdirectories are listed, so only one
+    directory is open at a time however deep the tree is.
+
+    Args:
+        root (str): Path to the directory to scan.
+
+    Yields:
+        os.DirEntry: Entry of each file, caching its stat() result.
+    """
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return
+
+    subdirectories = []
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+    for subdirectory in subdirectories:
+        yield from iter_file_entries(subdirectory)
+
+
+def list_file_entries(root):
+    """
+    List (path, size, timestamp) for every regular file below a directory, sorted by
+    (device, inode) so that files are read in roughly on-disk order.
+
+    Each file is stat'ed once here and not again when it is hashed.
+
+    Args:
+        root (str): Path to the directory to scan.
+
+    Returns:
+        list: (file_path, file_size, file_timestamp) of each file.
+    """
+    file_entries = []
+    for entry in iter_file_entries(root):
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue  # Removed since the directory was listed, or not accessible
+        file_entries.append((stat.st_dev, stat.st_ino, entry.path, stat.st_size, stat.st_mtime))
+
+    file_entries.sort()
+    return [file_entry[2:] for file_entry in file_entries]
+
+
+def calculate_numeric_hash(file_path, hash_algorithm="blake3", max_threads=1):
+    """
+    Calculate the hash of a file as a numeric value truncated to 64 bits.
+
+    Args:
+        file_path (str): Path to the file.
+        hash_algorithm (str): 'blake3' or any hashlib algorithm name (default: 'blake3').
+        max_threads (int): Threads blake3 may use for one file, None for one per core.
+            Keep the default 1 when files are already hashed concurrently (default: 1).
+
+    Returns:
+        int: Lower 64 bits of the hash (first 8 digest bytes, little-endian, for blake3).
+    """
+    if hash_algorithm == "blake3":
+        import blake3  # Only needed for blake3, so sha256 and md5 work without it
+
+        hash_func = blake3.blake3(max_threads=blake3.blake3.AUTO if max_threads is None else max_threads)
+    else:
+        hash_func = hashlib.new(hash_algorithm)
+
+    # Reuse this thread's buffer, so hashing allocates nothing per file or per chunk
+    if not hasattr(_read_buffers, "view"):
+        _read_buffers.view = memoryview(bytearray(READ_CHUNK_SIZE))
+    view = _read_buffers.view
+
+    with open(file_path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):  # Readahead hints, not available on Windows
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while num_read := f.readinto(view):
+            hash_func.update(view[:num_read])
+
+    if hash_algorithm == "blake3":
+        return int.from_bytes(hash_func.digest(length=8), "little")
+    return int(hash_func.hexdigest(), 16) & ((1 << 64) - 1)
+
+
+def matches_baseline(file_entry, directory, path_to_idx, baseline_sizes, baseline_timestamps):
+    """
+    Check whether a file's size and timestamp equal those of its baseline entry, in
+    which case its content is taken as unchanged and it does not need to be hashed.
+
+    Args:
+        file_entry (tuple): (file_path, file_size, file_timestamp) from list_file_entries.
+        directory (str): Path to the scanned directory.
+        path_to_idx (dict): Maps each baseline path (relative to the directory) to its index.
+        baseline_sizes (np.ndarray): Baseline file sizes.
+        baseline_timestamps (np.ndarray): Baseline file timestamps.
+
+    Returns:
+        bool: True if the file matches its baseline entry.
+    """
+    file_path, file_size, file_timestamp = file_entry
+    idx = path_to_idx.get(os.path.relpath(file_path, directory))
+    return idx is not None and file_size == baseline_sizes[idx] and file_timestamp == baseline_timestamps[idx]
+
+
+def encode_paths(paths):
+    """
+    Pack file paths into one UTF-8 byte blob plus an offsets array, so that the .npz
+    stores each path in its own length instead of padding all of them to the longest.
+
+    Args:
+        paths (list): File paths.
+
+    Returns:
+        tuple: (blob, offsets) where blob (np.uint8) holds the encoded paths back to back
+        and path i is blob[offsets[i]:offsets[i + 1]] (offsets is np.int64, one longer than paths).
+    """
+    encoded = [os.fsencode(path) for path in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def decode_paths(blob, offsets):
+    """
+    Unpack the file paths packed by encode_paths.
+
+    Args:
+        blob (np.ndarray): Encoded paths back to back (np.uint8).
+        offsets (np.ndarray): Start of each path in the blob, followed by the blob length.
+
+    Returns:
+        list: File paths.
+    """
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [os.fsdecode(data[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
@@ -1,60 +1,45 @@
-import threading
-from joblib import Parallel, delayed
+import numpy as np
+from numba import njit, prange
 from time import perf_counter
 
-perf_counter_thread = perf_counter()
+# Sum the squares of 0 .. n - 1 (the six 1,000,000-wide ranges of the original threads)
+n = 6_000_000
 
+perf_counter_closed_form = perf_counter()
 
-# Function to compute the sum of squares in a given range
-def compute_sum_of_squares(start, end, results, index):
-    total = sum(x * x for x in range(start, end))
-    results[index] = total
-
-
-# Number of threads
-num_threads = 6
-
-# Results array to store the sum of squares for each thread
-results = [0] * num_threads
-
-# Create and start threads
-threads = []
-for i in range(num_threads):
-    start = i * 1000000
-    end = (i + 1) * 1000000
-    thread = threading.Thread(target=compute_sum_of_squares, args=(start, end, results, i))
-    threads.append(thread)
-    thread.start()
-
-# Wait for all threads to complete
-for thread in threads:
-    thread.join()
-
-# Sum up the results from all threads
-total_sum_of_squares = sum(results)
+# Closed form of sum(x * x for x in range(n)), exact with Python integers
+total_sum_of_squares = (n - 1) * n * (2 * n - 1) // 6
 print(f"Total sum of squares: {total_sum_of_squares}")
 
-print("Total time for threading:", perf_counter() - perf_counter_thread)
+print("Total time for closed form:", perf_counter() - perf_counter_closed_form)
 
-perf_counter_joblib = perf_counter()
 
+# Widest chunk whose partial sum stays below the int64 limit (the full total does not fit):
+# each square is below n * n. Requires n * n itself to fit, i.e. n below about 3e9
+chunk_size = max(1, (2**63 - 1) // (n * n))
 
-# Function to compute the sum of squares for a range of numbers
-def compute_sum_of_squares(start, end):
-    return sum(x * x for x in range(start, end))
 
+# Function to compute the sum of squares of each chunk of the range, one chunk per iteration
+@njit(parallel=True)
+def compute_sum_of_squares(n, chunk_size):
+    num_chunks = (n + chunk_size - 1) // chunk_size
+    partial_sums = np.zeros(num_chunks, dtype=np.int64)
+    for chunk in prange(num_chunks):
+        total = 0
+        for x in range(chunk * chunk_size, min((chunk + 1) * chunk_size, n)):
+            total += x * x
+        partial_sums[chunk] = total
+    return partial_sums
 
-# Number of jobs (equivalent to number of threads)
-num_jobs = 6
 
-# Define the ranges for each job
-ranges = [(i * 1000000, (i + 1) * 1000000) for i in range(num_jobs)]
+# Compile once so the timing below measures the computation only
+compute_sum_of_squares(chunk_size, chunk_size)
 
-# Use joblib to parallelize the computation using threads
-results = Parallel(n_jobs=num_jobs, backend='threading')(delayed(compute_sum_of_squares)(start, end) for start, end in ranges)
+perf_counter_numba = perf_counter()
 
-# Sum up the results from all jobs
-total_sum_of_squares = sum(results)
+# Sum up the partial results with Python integers to avoid overflow
+partial_sums = compute_sum_of_squares(n, chunk_size)
+total_sum_of_squares = sum(int(partial_sum) for partial_sum in partial_sums)
 print(f"Total sum of squares: {total_sum_of_squares}")
 
-print("Total time for parallel computing:", perf_counter() - perf_counter_joblib)
+print("Total time for numba prange:", perf_counter() - perf_counter_numba)